@@ -0,0 +1,272 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from astropy.io import fits
+from astropy.table import Table
+
+# the modules in uvot-mosaic import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import uvot_scattered_light
+
+
+BACKENDS = ['numpy',
+                pytest.param('numexpr', marks=pytest.mark.skipif(uvot_scattered_light.ne is None,
+                                                                     reason='numexpr not installed')),
+                pytest.param('numba', marks=pytest.mark.skipif(uvot_scattered_light.njit is None,
+                                                                   reason='numba not installed'))]
+
+
+def baseline_counts_image(sk_array, sl_array, exp_param, flat_param):
+    """
+    The original calc_counts_image math (done in float64), for comparison
+    """
+
+    sl_copy = sl_array.astype(np.float64)
+    fov = np.where(sl_copy > 0)
+    sl_copy[fov] -= np.min(sl_copy[fov])
+    sl_copy[fov] = exp_param**sl_copy[fov]
+    sl_copy = sl_copy / np.mean(sl_copy[fov])
+    m = np.mean(sl_copy[fov])
+    sl_copy -= m
+    sl_copy *= flat_param
+    sl_copy += m
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sk_array / sl_copy
+
+
+def make_images():
+    """
+    Synthetic SK/SL pair: a circular FoV with a 0 border around it
+    """
+
+    yy, xx = np.mgrid[0:64, 0:80]
+    r = np.hypot(yy - 32, xx - 40)
+    in_fov = r < 25
+
+    sl_array = np.where(in_fov, 3.0 - 0.08*r, 0).astype(np.float32)
+    rng = np.random.RandomState(12345)
+    sk_array = np.where(in_fov, rng.poisson(20, size=r.shape) + 1, 0).astype(np.float32)
+
+    return sk_array, sl_array
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_matches_baseline(backend):
+    sk_array, sl_array = make_images()
+    sl_orig = sl_array.copy()
+    fov = sl_array > 0
+
+    new_image = uvot_scattered_light.calc_counts_image(sk_array, sl_array, 1.2, 0.4, backend=backend)
+    expected = baseline_counts_image(sk_array, sl_array, 1.2, 0.4)
+
+    assert new_image.dtype == np.float32
+    np.testing.assert_allclose(new_image[fov], expected[fov], rtol=1e-4)
+    # the border is left at 0
+    assert np.all(new_image[~fov] == 0)
+    # the SL image isn't modified
+    np.testing.assert_array_equal(sl_array, sl_orig)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_empty_fov(backend):
+    sk_array, sl_array = make_images()
+
+    new_image = uvot_scattered_light.calc_counts_image(sk_array, np.zeros_like(sl_array), 1.2, 0.4,
+                                                           backend=backend)
+
+    assert new_image.dtype == np.float32
+    assert np.all(new_image == 0)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_nan_sl_pixels(backend):
+    sk_array, sl_array = make_images()
+    # NaNs where reproject didn't cover the sky, both in the border and the FoV
+    sl_array[:5,:] = np.nan
+    sl_array[30:33, 38:43] = np.nan
+    fov = sl_array > 0
+
+    new_image = uvot_scattered_light.calc_counts_image(sk_array, sl_array, 1.2, 0.4, backend=backend)
+    expected = baseline_counts_image(sk_array, sl_array, 1.2, 0.4)
+
+    np.testing.assert_allclose(new_image[fov], expected[fov], rtol=1e-4)
+    assert np.all(new_image[~fov] == 0)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_big_endian(backend):
+    sk_array, sl_array = make_images()
+
+    # FITS data is big-endian
+    new_image = uvot_scattered_light.calc_counts_image(sk_array.astype('>f4'), sl_array.astype('>f4'),
+                                                           1.2, 0.4, backend=backend)
+    expected = uvot_scattered_light.calc_counts_image(sk_array, sl_array, 1.2, 0.4, backend=backend)
+
+    np.testing.assert_array_equal(new_image, expected)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_shape_mismatch(backend):
+    sk_array, sl_array = make_images()
+
+    with pytest.raises(ValueError):
+        uvot_scattered_light.calc_counts_image(sk_array[:60,:60], sl_array, 1.2, 0.4, backend=backend)
+
+
+def test_unknown_backend():
+    sk_array, sl_array = make_images()
+
+    with pytest.raises(ValueError):
+        uvot_scattered_light.calc_counts_image(sk_array, sl_array, 1.2, 0.4, backend='cuda')
+
+
+# ------------------------
+# the full manual/apply steps, on small FITS files
+# ------------------------
+
+class FakeFITSFigure(object):
+    """
+    Stand-in for aplpy.FITSFigure that doesn't draw anything
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.ticks = self
+        self.frame = self
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+@pytest.fixture
+def no_display(monkeypatch):
+    monkeypatch.setattr(uvot_scattered_light.aplpy, 'FITSFigure', FakeFITSFigure)
+    yield
+    plt.close('all')
+
+
+def set_inputs(monkeypatch, responses):
+    """
+    Answer the run_manual prompts with responses (in order)
+    """
+
+    responses = iter(responses)
+
+    def fake_input(prompt=''):
+        try:
+            return next(responses)
+        except StopIteration:
+            raise AssertionError('unexpected prompt: '+prompt)
+
+    monkeypatch.setattr('builtins.input', fake_input)
+
+
+def write_obs(im_path, obs, filt, extnames, tstarts):
+    """
+    Make the uvot_deep files that fix_sl uses for one observation, and return
+    a dictionary of EXTNAME: (sk_array, sl_array)
+    """
+
+    image_dir = os.path.join(im_path, obs, 'uvot', 'image')
+    os.makedirs(image_dir)
+    prefix = os.path.join(image_dir, 'sw'+obs+'u'+filt)
+
+    sk_array, sl_array = make_images()
+
+    hdu_sk = fits.HDUList([fits.PrimaryHDU()])
+    hdu_sl = fits.HDUList([fits.PrimaryHDU()])
+    arrays = {}
+    for k, (extname, tstart) in enumerate(zip(extnames, tstarts)):
+        header = fits.Header()
+        header['EXTNAME'] = extname
+        header['TSTART'] = tstart
+        arrays[extname] = (sk_array * (k+1), sl_array + 0.1*k)
+        hdu_sk.append(fits.ImageHDU(data=arrays[extname][0], header=header))
+        hdu_sl.append(fits.ImageHDU(data=arrays[extname][1], header=header))
+    hdu_sk.writeto(prefix+'_sk_corr.img')
+    hdu_sl.writeto(prefix+'.sl')
+
+    # only the name of the original sky image is used (to find the filters)
+    fits.PrimaryHDU().writeto(prefix+'_sk.img')
+
+    return arrays
+
+
+def test_fix_sl(tmp_path, monkeypatch, no_display):
+    im_path = str(tmp_path) + '/'
+    arrays = write_obs(im_path, '00000000001', 'w1', ['A1','A2'], [1000.5, 2000.5])
+    arrays.update(write_obs(im_path, '00000000002', 'w1', ['B1'], [3000.5]))
+
+    # the uvot_deep counts image sets the extension order for the output
+    extname_order = ['B1','A2','A1']
+    hdu_all = fits.HDUList([fits.PrimaryHDU()])
+    for extname in extname_order:
+        header = fits.Header()
+        header['EXTNAME'] = extname
+        hdu_all.append(fits.ImageHDU(data=np.zeros((2,2), dtype=np.float32), header=header))
+    hdu_all.writeto(im_path+'test_w1_sk_all.fits')
+
+    # keep the starting parameters for every snapshot
+    set_inputs(monkeypatch, ['']*3)
+
+    uvot_scattered_light.fix_sl(['00000000002','00000000001'], 'test_', filter_list=['w1'],
+                                    im_path=im_path)
+
+    with fits.open(im_path+'test_w1_sk_all_sl.fits') as hdu_new:
+        assert [hdu.header['EXTNAME'] for hdu in hdu_new[1:]] == extname_order
+        for hdu in hdu_new[1:]:
+            expected = uvot_scattered_light.calc_counts_image(*arrays[hdu.header['EXTNAME']], 1.2, 0.4)
+            assert hdu.data.dtype.itemsize == 4
+            np.testing.assert_allclose(hdu.data, expected, rtol=1e-6)
+
+    # parameters are saved for each snapshot, with no temporary files left
+    for obs, tstarts in [('00000000001', [1000.5, 2000.5]), ('00000000002', [3000.5])]:
+        image_dir = os.path.join(im_path, obs, 'uvot', 'image')
+        sl_data = Table.read(os.path.join(image_dir, 'sw'+obs+'uw1_sl.info'), format='ascii')
+        assert list(sl_data['tstart']) == tstarts
+        assert np.all(sl_data['exp_param'] == 1.2)
+        assert not any(f.endswith('.tmp') for f in os.listdir(image_dir))
+        assert os.path.isfile(os.path.join(image_dir, 'sw'+obs+'uw1_sk_corr_sl.img'))
+
+
+def test_sl_manual_redo_and_apply(tmp_path, monkeypatch, no_display):
+    im_path = str(tmp_path) + '/'
+    arrays = write_obs(im_path, '00000000001', 'w1', ['A1','A2'], [1000.5, 2000.5])
+    prefix = im_path + '00000000001/uvot/image/sw00000000001uw1'
+    sk_image = prefix + '_sk_corr.img'
+    sl_image = prefix + '.sl'
+    sl_file = prefix + '_sl.info'
+
+    # first time through: new rows with the starting parameters
+    set_inputs(monkeypatch, ['']*2)
+    uvot_scattered_light.sl_manual(sk_image, sl_image, sl_file)
+    sl_data = Table.read(sl_file, format='ascii')
+    assert len(sl_data) == 2
+    assert np.all(sl_data['exp_param'] == 1.2)
+
+    # redo: the existing rows are updated (not added again)
+    set_inputs(monkeypatch, ['1.5 0.3', '', '1.5, 0.3', ''])
+    uvot_scattered_light.sl_manual(sk_image, sl_image, sl_file, fix_redo=True)
+    sl_data = Table.read(sl_file, format='ascii')
+    assert list(sl_data['tstart']) == [1000.5, 2000.5]
+    assert np.all(sl_data['exp_param'] == 1.5)
+    assert np.all(sl_data['flat_param'] == 0.3)
+
+    # no redo: everything is skipped, so there shouldn't be any prompts
+    set_inputs(monkeypatch, [])
+    uvot_scattered_light.sl_manual(sk_image, sl_image, sl_file)
+    assert np.all(Table.read(sl_file, format='ascii')['exp_param'] == 1.5)
+
+    # apply the corrections
+    hdu_new = uvot_scattered_light.sl_apply(sk_image, sl_image, sl_file)
+    assert isinstance(hdu_new, fits.HDUList)
+    assert [hdu.header['EXTNAME'] for hdu in hdu_new[1:]] == ['A1','A2']
+    for hdu in hdu_new[1:]:
+        expected = uvot_scattered_light.calc_counts_image(*arrays[hdu.header['EXTNAME']], 1.5, 0.3)
+        np.testing.assert_allclose(hdu.data, expected, rtol=1e-6)
+    assert os.path.isfile(prefix + '_sk_corr_sl.img')
@@ -1,19 +1,35 @@
 import numpy as np
 import matplotlib.pyplot as plt
-import glob
 import os
+import multiprocessing
+import concurrent.futures
+import collections
+import itertools
 import subprocess
-import copy
 
 from astropy.io import fits
 from astropy.table import Table
-from astropy.convolution import Gaussian2DKernel
-from astropy.convolution import convolve
-from astropy.stats import biweight_location, sigma_clip, biweight_midvariance
+from astropy.stats import biweight_location, sigma_clipped_stats, biweight_midvariance
+from scipy.ndimage import gaussian_filter1d
 import aplpy
 
+# numba is optional: if it's available, calc_counts_image uses a compiled kernel
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    njit = None
+
+# numexpr is also optional: if numba isn't available, it's the next choice
+try:
+    import numexpr as ne
+except ImportError:
+    ne = None
+
 import pdb
 
+# width (in pixels) of the Gaussian used to smooth images for display
+_SMOOTH_SIGMA = 8
+
 def fix_sl(input_folders,
                   output_prefix,
                   filter_list=['w2','m2','w1','uu','bb','vv'],
@@ -24,6 +40,8 @@ def fix_sl(input_folders,
 
     The parameterization is currently fairly arbitrary (though hopefully will be better quantified soon!).  Parameters will be saved in a file in the image folder.
 
+    Once the manual part is done, the corrections are applied in parallel using freshly started ("spawned") processes.  Each of those processes imports your main script.  This is a change from earlier versions: a script that calls fix_sl at the top level (rather than under an ``if __name__ == '__main__':`` block) will now fail, because every process tries to run the whole script again.  Calling fix_sl interactively works as before.
+
     Parameters
     ----------
     input_folders : list of strings
@@ -53,14 +71,19 @@ def fix_sl(input_folders,
     # identify the filters in each snapshot
     # ------------------------
 
-    # dictionary to hold filters that exist for each folder
-    filter_exist = {key:[] for key in input_folders}
-    
-    for i in input_folders:
+    # dictionary to hold the folders that exist for each filter
+    obs_by_filter = {key:[] for key in filter_list}
+    filter_set = frozenset(filter_list)
+
+    for i in sorted(set(input_folders)):
 
         # list all of the sky images
-        sk_list = glob.glob(im_path + i + '/uvot/image/*_sk.img')
-       
+        image_dir = im_path + i + '/uvot/image'
+        sk_list = []
+        if os.path.isdir(image_dir):
+            with os.scandir(image_dir) as it:
+                sk_list = [e.name for e in it if e.name.endswith('_sk.img')]
+
         # check that images exist
         if len(sk_list) == 0:
             print('No images found for input folder: ' + i)
@@ -68,79 +91,119 @@ def fix_sl(input_folders,
         # grab the filter from the filename of each sky image
         for sk in sk_list:
             filter_name = sk[-9:-7]
-            if filter_name in filter_list:
-                filter_exist[i].append(filter_name)
+            if filter_name in filter_set and i not in obs_by_filter[filter_name][-1:]:
+                obs_by_filter[filter_name].append(i)
 
 
     # ------------------------
     # go through each filter and build the images
     # ------------------------
 
-    for filt in filter_list:
+    # pool for applying the corrections, shared by all of the filters
+    # - use fresh processes rather than forking this one, which will have
+    #   matplotlib (and maybe numba) threads running from the manual part
+    # - the processes are started when the first jobs are submitted
+    n_workers = os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=_init_worker) as executor:
 
-        # get the images that have observations in that filter
-        obs_list = [im for im in sorted(filter_exist.keys()) if filt in filter_exist[im]]
+        for filt in filter_list:
 
-        # check that images exist
-        if len(obs_list) == 0:
-            print('No images found for filter: ' + filt)
-            continue
+            # get the images that have observations in that filter
+            # (already sorted, since the folders were checked in order)
+            obs_list = obs_by_filter[filt]
+
+            # check that images exist
+            if len(obs_list) == 0:
+                print('No images found for filter: ' + filt)
+                continue
 
-        # HDU to keep all the HDUs together
-        hdu_all = fits.HDUList()
+            # list of (sk_image, sl_image, sl_file) for applying the corrections
+            apply_jobs = []
 
-        
-        for obs in obs_list:
 
-            print('')
-            print('*************************************************************')
-            print('  observation ', obs, ', filter = ', filt)
-            print('*************************************************************')
-            print('')
+            for obs in obs_list:
 
-            
-            # the SL image file for this obs/filter
-            sl_image = im_path + obs+'/uvot/image/sw'+obs+'u'+filt+'.sl'
+                print('')
+                print('*************************************************************')
+                print('  observation ', obs, ', filter = ', filt)
+                print('*************************************************************')
+                print('')
 
-            # check that it exists
-            if not os.path.isfile(sl_image):
-                print('No scattered light image for '+filt+' in '+obs)
-                continue
 
-            # the sky (counts) image, corrected for LSS
-            sk_image = im_path + obs+'/uvot/image/sw'+obs+'u'+filt+'_sk_corr.img'
+                # the SL image file for this obs/filter
+                sl_image = im_path + obs+'/uvot/image/sw'+obs+'u'+filt+'.sl'
 
-            # file where SL fits will be saved
-            sl_file = im_path + obs+'/uvot/image/sw'+obs+'u'+filt+'_sl.info'
+                # check that it exists
+                if not os.path.isfile(sl_image):
+                    print('No scattered light image for '+filt+' in '+obs)
+                    continue
 
-            # do the manual adjusting
-            sl_manual(sk_image, sl_image, sl_file, fix_redo=fix_redo)
+                # the sky (counts) image, corrected for LSS
+                sk_image = im_path + obs+'/uvot/image/sw'+obs+'u'+filt+'_sk_corr.img'
+
+                # file where SL fits will be saved
+                sl_file = im_path + obs+'/uvot/image/sw'+obs+'u'+filt+'_sl.info'
+
+                # do the manual adjusting (interactive, so this stays serial)
+                sl_manual(sk_image, sl_image, sl_file, fix_redo=fix_redo)
+
+                apply_jobs.append((sk_image, sl_image, sl_file))
+
+            # check that there's something to apply
+            if len(apply_jobs) == 0:
+                print('No scattered light images found for filter: ' + filt)
+                continue
 
             # apply the parameters to the images
-            hdu_obs = sl_apply(sk_image, sl_image, sl_file)
+            # (the extensions are independent, so they're all done in parallel)
 
-            # append the HDUs to the master list
-            if len(hdu_all) == 0:
-                hdu_all += copy.deepcopy(hdu_obs)
-            else:
-                hdu_all += copy.deepcopy(hdu_obs[1:])
+            # every extension of every observation, in order
+            obs_ext_jobs = [_sl_apply_jobs(*job) for job in apply_jobs]
 
+            # results come back in the same order, and only a couple of jobs
+            # per worker are in flight at a time, so finished images that
+            # are waiting to be written can't pile up
+            results = _bounded_map(executor, _process_ext,
+                                       (ext_job for ext_jobs in obs_ext_jobs for ext_job in ext_jobs),
+                                       2*n_workers)
 
-        # put the master HDU list into the same order as the uvot_deep counts image
-        hdu_all_reorder = fits.HDUList()
-        hdu_all_reorder.append(hdu_obs[0])
+            # write each observation's file as its results come in
+            sl_corr_list = []
+            for (sk_image, sl_image, sl_file), ext_jobs in zip(apply_jobs, obs_ext_jobs):
+                print('applying SL corrections to '+sk_image)
+                sl_corr_list.append(_write_sl_corr(sk_image, itertools.islice(results, len(ext_jobs))))
+
+            # HDU to keep all the HDUs together
+            hdu_all = fits.HDUList()
+
+            for sl_corr_image in sl_corr_list:
+
+                with fits.open(sl_corr_image, memmap=False) as hdu_obs:
+
+                    # append the HDUs to the master list
+                    for i in range(0 if len(hdu_all) == 0 else 1, len(hdu_obs)):
+                        hdu_all.append(fits.ImageHDU(data=hdu_obs[i].data, header=hdu_obs[i].header))
+
+                    hdu_primary = fits.ImageHDU(data=hdu_obs[0].data, header=hdu_obs[0].header)
 
-        hdu_all_extname = [hdu_all[i].header['EXTNAME'] for i in range(1,len(hdu_all))]
-        
-        with fits.open(im_path + output_prefix + filt + '_sk_all.fits') as hdu_orig:
 
-            for i in range(1,len(hdu_orig)):
+            # put the master HDU list into the same order as the uvot_deep counts image
+            hdu_all_reorder = fits.HDUList()
+            hdu_all_reorder.append(hdu_primary)
 
-                match_ind = hdu_all_extname.index(hdu_orig[i].header['EXTNAME'])
-                hdu_all_reorder.append(hdu_all[match_ind+1])
+            hdu_all_extname = [hdu_all[i].header['EXTNAME'] for i in range(1,len(hdu_all))]
 
-        # save it
-        hdu_all_reorder.writeto(im_path + output_prefix + filt + '_sk_all_sl.fits', overwrite=True)
+            with fits.open(im_path + output_prefix + filt + '_sk_all.fits') as hdu_orig:
+
+                for i in range(1,len(hdu_orig)):
+
+                    match_ind = hdu_all_extname.index(hdu_orig[i].header['EXTNAME'])
+                    hdu_all_reorder.append(hdu_all[match_ind+1])
+
+            # save it
+            hdu_all_reorder.writeto(im_path + output_prefix + filt + '_sk_all_sl.fits', overwrite=True)
 
 
 def sl_apply(sk_image, sl_image, sl_file):
@@ -163,37 +226,119 @@ def sl_apply(sk_image, sl_image, sl_file):
     -------
     hdu_new : HDU
         the list of HDUs with corrected counts images
-    
+
     """
 
     print('applying SL corrections to sky image')
 
+    ext_jobs = _sl_apply_jobs(sk_image, sl_image, sl_file)
+
+    # write out the file (one extension at a time)
+    sl_corr_image = _write_sl_corr(sk_image, map(_process_ext, ext_jobs))
+
+    # return all the adjusted HDUs
+    with fits.open(sl_corr_image, memmap=False) as hdu_corr:
+        hdu_new = fits.HDUList([fits.ImageHDU(data=hdu.data, header=hdu.header) for hdu in hdu_corr])
+
+    return hdu_new
+
+
+def _sl_apply_jobs(sk_image, sl_image, sl_file):
+    """
+    Make the list of _process_ext inputs for each extension of an image
+    """
+
     # read SL corrections
     sl_data = Table.read(sl_file, format='ascii')
-    
-    with fits.open(sk_image) as hdu_sk, fits.open(sl_image) as hdu_sl:
 
-        # HDU to hold the new images
-        hdu_new = fits.HDUList()
-        # first empty extension
-        hdu_new.append(fits.ImageHDU(data=hdu_sk[0].data, header=hdu_sk[0].header))
+    with fits.open(sk_image, memmap=True, do_not_scale_image_data=True) as hdu_sk:
+        n_ext = len(hdu_sk)
 
-        for i in range(1,len(hdu_sk)):
+    # each extension is read from the files by whichever process corrects it
+    return [(sk_image, sl_image, i,
+                 float(sl_data['exp_param'][i-1]), float(sl_data['flat_param'][i-1]))
+                for i in range(1,n_ext)]
 
-            # calculate scaled SL image
-            new_image = calc_counts_image(hdu_sk[i].data, hdu_sl[i].data,
-                                              sl_data['exp_param'][i-1],
-                                              sl_data['flat_param'][i-1])
 
-            # append to HDU list
-            hdu_new.append(fits.ImageHDU(data=new_image, header=hdu_sk[i].header))
+def _write_sl_corr(sk_image, results):
+    """
+    Save the corrected counts images for sk_image, where results gives
+    (i, new_image) for each extension in order, and return the file name
+    """
 
-        # write out the file
-        hdu_new.writeto(sk_image.replace('_corr.img','_corr_sl.img'), overwrite=True)
+    # file for the corrected images
+    sl_corr_image = sk_image.replace('_corr.img','_corr_sl.img')
+
+    with fits.open(sk_image, memmap=True, do_not_scale_image_data=True) as hdu_sk:
+
+        # start the new file with the first empty extension
+        fits.PrimaryHDU(data=hdu_sk[0].data, header=hdu_sk[0].header).writeto(sl_corr_image, overwrite=True)
+
+        # append each extension to the file as it comes back (in extension order)
+        # - the data is dropped once it's written, so the output list doesn't
+        #   hold on to every image (any results that are done early and waiting
+        #   to be written are held by whatever is making them, e.g. _bounded_map)
+        with fits.open(sl_corr_image, mode='append') as hdu_out:
+
+            for i, new_image in results:
+
+                hdu_out.append(fits.ImageHDU(data=new_image, header=hdu_sk[i].header))
+                hdu_out.flush()
+                del hdu_out[-1].data
+                del new_image
+
+    return sl_corr_image
+
+
+def _bounded_map(executor, func, jobs, max_pending):
+    """
+    Like executor.map(func, jobs), but only max_pending jobs are submitted
+    at a time, so that at most that many results are ever waiting to be used
+    """
+
+    jobs = iter(jobs)
+    pending = collections.deque(executor.submit(func, job)
+                                    for job in itertools.islice(jobs, max_pending))
+
+    while pending:
+        result = pending.popleft().result()
+        # start the next job before handing this result back
+        for job in itertools.islice(jobs, 1):
+            pending.append(executor.submit(func, job))
+        yield result
+
+
+def _process_ext(args):
+    """
+    Calculate the corrected counts image for one extension
+
+    args is (sk_image, sl_image, i, exp_param, flat_param), and the output is
+    (i, new_image).  Everything is read from the files here, so that only
+    the file names need to be sent to a worker process.
+    """
+
+    sk_image, sl_image, i, exp_param, flat_param = args
+
+    with fits.open(sk_image, memmap=True, do_not_scale_image_data=True) as hdu_sk, \
+         fits.open(sl_image, memmap=True, do_not_scale_image_data=True) as hdu_sl:
+
+        new_image = calc_counts_image(hdu_sk[i].data, hdu_sl[i].data,
+                                          exp_param, flat_param)
+
+    return i, new_image
+
+
+def _init_worker():
+    """
+    Keep each worker process to one thread, since the process pool is
+    already using all of the cores
+    """
+
+    if njit is not None:
+        set_num_threads(1)
+    if ne is not None:
+        ne.set_num_threads(1)
 
-    # return all the adjusted HDUs
-    return hdu_new
-    
 
 def sl_manual(sk_image, sl_image, sl_file, fix_redo=False):
     """
@@ -226,40 +371,56 @@ def sl_manual(sk_image, sl_image, sl_file, fix_redo=False):
     else:
         sl_data = Table(names=('tstart','exp_param','flat_param'))
 
-    
-    with fits.open(sk_image) as hdu_sk, fits.open(sl_image) as hdu_sl:
-
-        for i in range(1,len(hdu_sk)):
-
-            # get start time (it's the most unique identifier for a given snapshot)
-            tstart = hdu_sk[i].header['tstart']
-
-            # that time is in the table, and fix_redo=True,
-            # OR
-            # that time isn't in the table
-            # -> do the calculations
-            if tstart in sl_data['tstart'] and fix_redo == True:
-                print('\nstarting manual corrections for extension '+str(i))
-                print('   larger exp_param -> more prominent circle')
-                print('   larger flat_param -> steeper radial gradient')
-                ind = np.where(tstart == sl_data['tstart'])[0][0]
-                exp_param, flat_param = run_manual(hdu_sk[i], hdu_sl[i], sl_data['exp_param'][ind],
-                                                       sl_data['flat_param'][ind])
-                sl_data['exp_param'][ind] = exp_param
-                sl_data['flat_param'][ind] = flat_param                
-                sl_data.write(sl_file, format='ascii', overwrite=True)
-            elif tstart not in sl_data['tstart']:
-                print('\nstarting manual corrections for extension '+str(i))
-                print('   larger exp_param -> more prominent circle')
-                print('   larger flat_param -> steeper radial gradient')
-                #exp_param, flat_param = run_manual(hdu_sk[i], hdu_sl[i], 1.5, 0.35)
-                exp_param, flat_param = run_manual(hdu_sk[i], hdu_sl[i], 1.2, 0.4)
-                sl_data.add_row([tstart, exp_param, flat_param])
-                sl_data.write(sl_file, format='ascii', overwrite=True)
-            # otherwise, skip it
-            else:
-                print('skipping manual corrections for extension '+str(i))
-            
+    # row number for each tstart, so the table doesn't have to be searched
+    tstart_idx = {t:k for k,t in enumerate(sl_data['tstart'])}
+
+
+    with fits.open(sk_image, memmap=True, do_not_scale_image_data=True) as hdu_sk, \
+         fits.open(sl_image, memmap=True, do_not_scale_image_data=True) as hdu_sl:
+
+        # the table only needs to be saved if something changed
+        dirty = False
+
+        try:
+            for i in range(1,len(hdu_sk)):
+
+                # get start time (it's the most unique identifier for a given snapshot)
+                tstart = hdu_sk[i].header['tstart']
+
+                # that time is in the table, and fix_redo=True,
+                # OR
+                # that time isn't in the table
+                # -> do the calculations
+                if tstart in tstart_idx and fix_redo == True:
+                    print('\nstarting manual corrections for extension '+str(i))
+                    print('   larger exp_param -> more prominent circle')
+                    print('   larger flat_param -> steeper radial gradient')
+                    ind = tstart_idx[tstart]
+                    exp_param, flat_param = run_manual(hdu_sk[i], hdu_sl[i], sl_data['exp_param'][ind],
+                                                           sl_data['flat_param'][ind])
+                    sl_data['exp_param'][ind] = exp_param
+                    sl_data['flat_param'][ind] = flat_param
+                    dirty = True
+                elif tstart not in tstart_idx:
+                    print('\nstarting manual corrections for extension '+str(i))
+                    print('   larger exp_param -> more prominent circle')
+                    print('   larger flat_param -> steeper radial gradient')
+                    #exp_param, flat_param = run_manual(hdu_sk[i], hdu_sl[i], 1.5, 0.35)
+                    exp_param, flat_param = run_manual(hdu_sk[i], hdu_sl[i], 1.2, 0.4)
+                    sl_data.add_row([tstart, exp_param, flat_param])
+                    tstart_idx[tstart] = len(sl_data) - 1
+                    dirty = True
+                # otherwise, skip it
+                else:
+                    print('skipping manual corrections for extension '+str(i))
+
+        finally:
+            # save the table once at the end (even if the manual part is
+            # interrupted, so the finished extensions aren't lost)
+            # - write to a temporary file first so a crash can't leave it half-written
+            if dirty:
+                sl_data.write(sl_file + '.tmp', format='ascii', overwrite=True)
+                os.replace(sl_file + '.tmp', sl_file)
 
 
 
@@ -288,25 +449,28 @@ def run_manual(hdu_sk, hdu_sl, exp_param, flat_param):
     """
 
     # smooth the counts image for easier viewing
-    kernel = Gaussian2DKernel(8)
-    hdu_sk_smooth = copy.copy(hdu_sk)
-    hdu_sk_smooth.data = convolve(hdu_sk.data, kernel)
+    sk_smooth = smooth_image(hdu_sk.data)
     # set up min/max
     #vmin = np.percentile(hdu_sk_smooth.data[hdu_sk_smooth.data > 0], 2)
     #vmin = biweight_location(hdu_sk_smooth.data[hdu_sk_smooth.data > 0])/1.5
     #vmin = biweight_location(hdu_sk_smooth.data[hdu_sk_smooth.data > 0]) \
     #       - biweight_midvariance(hdu_sk_smooth.data[hdu_sk_smooth.data > 0])
-    filt = sigma_clip(hdu_sk_smooth.data[hdu_sk_smooth.data > 0], sigma=2, iters=3)
-    vmin = np.mean(filt.data[~filt.mask]) - 2.5*np.std(filt.data[~filt.mask])
-    vmax = np.percentile(hdu_sk_smooth.data[hdu_sk_smooth.data > 0], 99)
+    # (the smoothed counts image doesn't change, so these are only done once)
+    pos = sk_smooth[sk_smooth > 0]
+    clip_mean, clip_median, clip_std = sigma_clipped_stats(pos, sigma=2, maxiters=3, stdfunc='mad_std')
+    vmin = clip_mean - 2.5*clip_std
+    # - only one quantile is needed, so a partial sort is enough
+    k = int(0.99*(len(pos)-1))
+    vmax = np.partition(pos, k)[k]
 
     # manually calculate log(image)
-    hdu_sk_smooth.data = log_image(hdu_sk_smooth.data, vmin, vmax)
+    # (aplpy only needs the data and the WCS in the header, so make a bare HDU)
+    hdu_sk_smooth = fits.ImageHDU(data=log_image(sk_smooth, vmin, vmax), header=hdu_sk.header)
+
+    # color scale for both panels
+    im_scale = [np.nanmin(hdu_sk_smooth.data), np.nanmax(hdu_sk_smooth.data)]
 
-    # make a copy to hold new smoothed images
-    hdu_sk_smooth_new = copy.copy(hdu_sk)
 
-    
     while True:
 
         # set up a figure
@@ -317,8 +481,6 @@ def run_manual(hdu_sk, hdu_sl, exp_param, flat_param):
         # plot original
         f = aplpy.FITSFigure(hdu_sk_smooth, figure=fig,
                                 subplot=[0, 0, 0.45, 1] )
-
-        im_scale = [np.nanmin(hdu_sk_smooth.data), np.nanmax(hdu_sk_smooth.data)]
                                 
         #f.show_colorscale(cmap='magma', stretch='log', vmin=vmin, vmax=vmax)
         f.show_colorscale(cmap='magma', stretch='linear', vmin=im_scale[0], vmax=im_scale[1])
@@ -334,12 +496,10 @@ def run_manual(hdu_sk, hdu_sl, exp_param, flat_param):
         new_image = calc_counts_image(hdu_sk.data, hdu_sl.data,
                                           exp_param, flat_param)
 
-        # smooth new image for displaying
-        hdu_sk_smooth_new.data = convolve(new_image, kernel)
+        # smooth new image for displaying, and manually calculate log(image)
+        hdu_sk_smooth_new = fits.ImageHDU(data=log_image(smooth_image(new_image), vmin, vmax),
+                                              header=hdu_sk.header)
 
-        # manually calculate log(image)
-        hdu_sk_smooth_new.data = log_image(hdu_sk_smooth_new.data, vmin, vmax)
-        
         # plot the new image
         f = aplpy.FITSFigure(hdu_sk_smooth_new, figure=fig,
                                 subplot=[0.5, 0, 0.45, 1] )
@@ -372,6 +532,25 @@ def run_manual(hdu_sk, hdu_sl, exp_param, flat_param):
     return exp_param, flat_param
 
 
+def smooth_image(image, sigma=_SMOOTH_SIGMA):
+    """
+    Smooth an image with a Gaussian for display
+
+    The 2D Gaussian is done as two 1D passes on a float32 copy of the image,
+    so there's no 2D kernel to build.  With the default truncation (4 sigma),
+    this is the same size as Gaussian2DKernel(sigma), and mode='constant'
+    matches the zero-fill boundary of astropy's convolve.  NaNs are set to 0.
+    """
+
+    smooth = np.nan_to_num(image.astype(np.float32), copy=False)
+
+    # each pass can be done in place
+    for axis in (0, 1):
+        gaussian_filter1d(smooth, sigma, axis=axis, output=smooth, mode='constant')
+
+    return smooth
+
+
 def log_image(image, min_val, max_val, ds9_a=1000):
     """
     Use the ds9 formalism to calculate a log (since aplpy log isn't playing nicely with negatives)
@@ -390,31 +569,139 @@ def log_image(image, min_val, max_val, ds9_a=1000):
     
 
 
-def calc_counts_image(sk_array, sl_array, exp_param, flat_param):
+def calc_counts_image(sk_array, sl_array, exp_param, flat_param, backend=None):
     """
     The math calculation:
     using the counts and SL images, output the new corrected counts image
+    (as float32, which is plenty for counts)
+
+    backend can be 'numba', 'numexpr', or 'numpy' to choose how the math is
+    done.  The default (None) is the first of those that's installed.  They
+    all give the same answer, and 'numpy' is the reference version.
     """
 
-    # copy the SL array so the original isn't modified (grumble grumble)
-    sl_copy = sl_array.copy()
+    if backend is None:
+        if njit is not None:
+            backend = 'numba'
+        elif ne is not None:
+            backend = 'numexpr'
+        else:
+            backend = 'numpy'
+    if backend not in ('numba','numexpr','numpy'):
+        raise ValueError('backend must be numba, numexpr, or numpy (got '+str(backend)+')')
+    if (backend == 'numba' and njit is None) or (backend == 'numexpr' and ne is None):
+        raise ImportError(backend+' backend requested, but '+backend+' is not installed')
+
+    # the numba kernel doesn't check its indices, so this has to be caught here
+    if sk_array.shape != sl_array.shape:
+        raise ValueError('sky and SL images have different shapes: '
+                             +str(sk_array.shape)+' and '+str(sl_array.shape))
+
+    # the images are opened without BSCALE/BZERO scaling (uvot_deep writes
+    # them as floats, so there isn't any), so cast them once here
+    # - this also gets them into native byte order for the math below
+    sk_array = sk_array.astype(np.float32, copy=False)
+    sl_array = sl_array.astype(np.float32, copy=False)
+
+    # the compiled kernel does everything, including the FoV mask
+    if backend == 'numba':
+        new_image = np.zeros(sk_array.shape, dtype=np.float32)
+        _calc_counts_core(sk_array, sl_array, np.float32(np.log(exp_param)),
+                              np.float32(flat_param), new_image)
+        return new_image
 
     # - ignore the giant 0 border
-    fov = np.where(sl_copy > 0)
-    
+    fov = sl_array > 0
+
+    # if there's no SL image at all, there's nothing to divide by
+    if not fov.any():
+        return np.zeros(sk_array.shape, dtype=np.float32)
+
+    # do the calculation with numexpr
+    # - the constants are float32 so that everything stays in float32
+    #   (exp_param**x is done as exp(log(exp_param)*x))
+    if backend == 'numexpr':
+        mn = np.min(sl_array, where=fov, initial=np.inf)
+        new_image = np.empty(sk_array.shape, dtype=np.float32)
+        # - exponentiate the SL image once, and get its mean
+        ne.evaluate('where(fov, exp(log_exp*(sl - mn)), 0)',
+                        local_dict={'fov':fov, 'sl':sl_array, 'mn':np.float32(mn),
+                                        'log_exp':np.float32(np.log(exp_param))},
+                        out=new_image)
+        mean1 = new_image.sum(dtype=np.float64) / np.count_nonzero(fov)
+        # - normalize, flatten, and divide: (scale/mean1 - 1)*flat_param + 1 = scale*a + b
+        ne.evaluate('where(fov, sk / (scale*a + b), 0)',
+                        local_dict={'fov':fov, 'sk':sk_array, 'scale':new_image,
+                                        'a':np.float32(flat_param/mean1), 'b':np.float32(1 - flat_param)},
+                        out=new_image)
+        return new_image
+
+    # the SL array is only read, and the scaled version goes into a new array
+    scale = np.zeros_like(sl_array, dtype=np.float32)
+
     # - subtract the minimum
-    sl_copy[fov] -= np.min(sl_copy[fov])
+    np.subtract(sl_array, sl_array[fov].min(), out=scale, where=fov)
     # - make the circle more prominent relative to bg
-    sl_copy[fov] = exp_param**sl_copy[fov]
+    np.power(exp_param, scale, out=scale, where=fov)
     # - make the mean = 1
-    sl_copy = sl_copy / np.mean(sl_copy[fov])
-    # - flatten it
-    m = np.mean(sl_copy[fov])
-    sl_copy -= m
-    sl_copy *= flat_param
-    sl_copy += m
-        
+    scale *= 1.0 / scale[fov].mean()
+    # - flatten it (the mean is now 1, so this is (sl-1)*flat_param + 1)
+    scale *= flat_param
+    scale += 1 - flat_param
+
     # make a new image: counts / scattered light
-    new_image = sk_array / sl_copy
+    # (border pixels are left at 0 rather than divided)
+    new_image = np.zeros(sk_array.shape, dtype=np.float32)
+    np.divide(sk_array, scale, out=new_image, where=fov, casting='unsafe')
 
     return new_image
+
+
+if njit is not None:
+
+    # seed for the FoV minimum (a finite number, rather than inf)
+    _FLOAT32_MAX = np.float32(np.finfo(np.float32).max)
+
+    # fastmath is limited to flags that keep NaN/inf handling correct
+    # (the SL images can have NaNs where reproject didn't cover the sky)
+    @njit(parallel=True, fastmath={'nsz','arcp','contract','afn','reassoc'}, cache=True)
+    def _calc_counts_core(sk, sl, log_exp, flat_param, out):
+        """
+        Same math as calc_counts_image, but done pixel-by-pixel in float32 so
+        that no temporary arrays are made.  log_exp is log(exp_param), so
+        exp_param**x is exp(log_exp*x).  The result is written into out,
+        which should start as zeros.
+        """
+
+        n_row, n_col = sl.shape
+
+        # minimum within the FoV (ignoring the giant 0 border)
+        mn = _FLOAT32_MAX
+        for i in prange(n_row):
+            for j in range(n_col):
+                if sl[i,j] > 0:
+                    mn = min(mn, sl[i,j])
+
+        # exponentiate the SL image (kept in out for the last pass) and get its mean
+        total = 0.0
+        n_fov = 0
+        for i in prange(n_row):
+            for j in range(n_col):
+                if sl[i,j] > 0:
+                    scale = np.exp(log_exp*(sl[i,j] - mn))
+                    out[i,j] = scale
+                    total += scale
+                    n_fov += 1
+
+        # if there's no SL image at all, leave the output as 0
+        if n_fov == 0:
+            return
+
+        # normalize, flatten, and divide into the counts
+        # - (scale/mean1 - 1)*flat_param + 1 = scale*a + b
+        a = np.float32(flat_param / (total / n_fov))
+        b = np.float32(1) - flat_param
+        for i in prange(n_row):
+            for j in range(n_col):
+                if sl[i,j] > 0:
+                    out[i,j] = sk[i,j] / (out[i,j]*a + b)